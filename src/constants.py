@@ -668,24 +668,41 @@ BUS_STOPS = {
     "222": {"13844", "3684", "3692", "3675", "4439", "4435", "3707", "3539", "3630", "3525", "3639", "3516", "32004"},
 }
 
-ROUTES_BUS = set(BUS_STOPS.keys())
+# these are read concurrently by every client thread and never modified, so freeze them
+BUS_STOPS = {route_id: frozenset(stop_ids) for route_id, stop_ids in BUS_STOPS.items()}
+# every stored (route_id, stop_id) bus stop, so checking whether an event is stored is a single lookup
+BUS_ROUTE_STOPS = frozenset((route_id, stop_id) for route_id, stop_ids in BUS_STOPS.items() for stop_id in stop_ids)
 
-ROUTES_CR = {
-    "CR-Fairmount",
-    "CR-Fitchburg",
-    "CR-Worcester",
-    "CR-Franklin",
-    "CR-Greenbush",
-    "CR-Haverhill",
-    "CR-Kingston",
-    "CR-Lowell",
-    "CR-Middleborough",
-    "CR-Needham",
-    "CR-Newburyport",
-    "CR-Providence",
-    "CR-Foxboro",
-}
+ROUTES_BUS = frozenset(BUS_STOPS)
+
+ROUTES_CR = frozenset(
+    {
+        "CR-Fairmount",
+        "CR-Fitchburg",
+        "CR-Worcester",
+        "CR-Franklin",
+        "CR-Greenbush",
+        "CR-Haverhill",
+        "CR-Kingston",
+        "CR-Lowell",
+        "CR-Middleborough",
+        "CR-Needham",
+        "CR-Newburyport",
+        "CR-Providence",
+        "CR-Foxboro",
+    }
+)
+
+ROUTES_RAPID = frozenset({"Red", "Blue", "Orange", "Green-B", "Green-C", "Green-D", "Green-E", "Mattapan"})
 
-ROUTES_RAPID = {"Red", "Blue", "Orange", "Green-B", "Green-C", "Green-D", "Green-E", "Mattapan"}
+# every stop on these routes is stored; bus routes only store the stops in BUS_STOPS
+ROUTES_RAIL = ROUTES_CR | ROUTES_RAPID
 
-ALL_ROUTES = ROUTES_BUS.union(ROUTES_CR).union(ROUTES_RAPID)
+ALL_ROUTES = ROUTES_BUS | ROUTES_RAIL
+
+# what kind of service each route is, so a route can be classified with a single lookup
+ROUTE_KIND = {
+    **{route_id: "bus" for route_id in ROUTES_BUS},
+    **{route_id: "cr" for route_id in ROUTES_CR},
+    **{route_id: "rapid" for route_id in ROUTES_RAPID},
+}
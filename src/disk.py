@@ -1,7 +1,16 @@
-import csv
+import atexit
 import os
 import pathlib
-from util import output_dir_path
+import queue
+import re
+import resource
+from collections import OrderedDict, defaultdict
+from datetime import date
+from functools import lru_cache
+from operator import itemgetter
+from threading import Event, Lock, Thread
+from typing import Optional
+from util import service_date, service_date_output_dir_path
 from ddtrace import tracer
 
 from config import CONFIG
@@ -26,24 +35,252 @@ CSV_FIELDS = [
     "scheduled_headway",
     "scheduled_tt",
 ]
+# rows are terminated the same way csv.DictWriter terminated them, so appends to existing files stay consistent
+CSV_LINE_TERMINATOR = "\r\n"
+CSV_HEADER = ",".join(CSV_FIELDS) + CSV_LINE_TERMINATOR
+CSV_HEADER_BYTES = CSV_HEADER.encode()
+_csv_field_values = itemgetter(*CSV_FIELDS)
+_needs_quoting = re.compile(r'[,"\r\n]').search
 DATA_DIR = pathlib.Path("data")
 STATE_FILENAME = "state.json"
 
+# events are handed to a single background writer thread, which writes whatever has queued up as one batch per file.
+# recently written event files are kept open as raw append-only descriptors, so that writing a batch is a single
+# os.write rather than a stat + open + close. rows aren't buffered once the writer has handled them, but events can
+# wait in the queue until it does, so use flush_events() or close_event_files() to be sure they're on disk.
+EVENT_FILE_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+MAX_BATCH_SIZE = 1000
+# how many event files are kept open. the default suits a process that only writes a few files; gobble itself
+# writes to every stored stop in the system (a few thousand files a day), so it calls size_open_files_cache()
+# at startup to keep a whole day's files open
+MAX_OPEN_FILES = 512
+# enough for every stored bus stop and rail platform, in each direction, with room for the service date rollover
+WANTED_OPEN_FILES = 8192
+# descriptors left over for everything other than event files: SSE connections, gtfs and trip state files, logs
+RESERVED_FDS = 256
+# the most buffers a single os.writev accepts. sysconf returns -1 when the limit is indeterminate, so fall back to
+# linux's limit rather than writing nothing at all
+IOV_MAX = os.sysconf("SC_IOV_MAX")
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
 
-def write_event(event: dict):
-    dirname = DATA_DIR / pathlib.Path(
-        output_dir_path(
-            event["route_id"],
-            event["direction_id"],
-            event["stop_id"],
-            event["event_time"],
-        )
+# if the writer falls this far behind, write_event blocks until it catches up rather than queueing without bound
+MAX_QUEUED_EVENTS = 50000
+
+_event_queue: queue.Queue = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+# put on the queue to stop the writer thread once everything ahead of it is written
+_STOP_WRITER = object()
+_writer_thread: Optional[Thread] = None
+_writer_thread_lock = Lock()
+# set by close_event_files, after which nothing more can be written
+_closed = False
+
+_open_files: "OrderedDict[pathlib.Path, int]" = OrderedDict()
+_open_files_lock = Lock()
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return ""
+    value = str(value)
+    # quote the same way csv.QUOTE_MINIMAL does
+    if _needs_quoting(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _format_row(event: dict) -> bytes:
+    try:
+        values = _csv_field_values(event)
+    except KeyError:
+        # missing fields are left blank, like csv.DictWriter's default restval
+        values = [event.get(field) for field in CSV_FIELDS]
+    return (",".join(map(_format_value, values)) + CSV_LINE_TERMINATOR).encode()
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _write_rows(fd: int, rows: list) -> None:
+    """Writes encoded rows with gathered writes, rather than joining them into one buffer first."""
+    for start in range(0, len(rows), IOV_MAX):
+        chunk = rows[start : start + IOV_MAX]
+        written = os.writev(fd, chunk)
+        if written < sum(map(len, chunk)):
+            # short writes are unusual for regular files, but finish the chunk rather than drop rows
+            _write_all(fd, b"".join(chunk)[written:])
+
+
+def _get_open_file(pathname: pathlib.Path) -> int:
+    """Returns an open append-only file descriptor for pathname, opening (and writing the header) if necessary."""
+    fd = _open_files.get(pathname)
+    if fd is not None:
+        _open_files.move_to_end(pathname)
+        return fd
+
+    try:
+        fd = os.open(pathname, EVENT_FILE_FLAGS, 0o644)
+    except FileNotFoundError:
+        # only the first file for a stop on a new service date needs its directory created
+        pathname.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(pathname, EVENT_FILE_FLAGS, 0o644)
+    # checked every time the file is opened, since it may have been removed or moved since we last had it open
+    try:
+        if os.fstat(fd).st_size == 0:
+            _write_all(fd, CSV_HEADER_BYTES)
+    except Exception:
+        os.close(fd)
+        raise
+    _open_files[pathname] = fd
+
+    if len(_open_files) > MAX_OPEN_FILES:
+        _, least_recently_used = _open_files.popitem(last=False)
+        os.close(least_recently_used)
+    return fd
+
+
+@lru_cache(maxsize=8192)
+def _events_csv_pathname(route_id: str, direction_id: str, stop_id: str, date: date) -> pathlib.Path:
+    # the same few thousand stop directories are written to all day, so only build each path once
+    return DATA_DIR / service_date_output_dir_path(route_id, direction_id, stop_id, date) / CSV_FILENAME
+
+
+def _event_pathname(event: dict) -> pathlib.Path:
+    return _events_csv_pathname(
+        event["route_id"],
+        event["direction_id"],
+        event["stop_id"],
+        service_date(event["event_time"]),
     )
-    dirname.mkdir(parents=True, exist_ok=True)
-    pathname = dirname / CSV_FILENAME
-    file_exists = os.path.isfile(pathname)
-    with pathname.open("a") as fd:
-        writer = csv.DictWriter(fd, fieldnames=CSV_FIELDS, extrasaction="ignore")
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(event)
+
+
+def _write_batch(items: list) -> bool:
+    """
+    Writes a batch of queued items: events are grouped into one write per file, and any flush requests
+    (threading.Events) are set once everything ahead of them is written. Returns whether the writer should stop.
+    """
+    rows_by_pathname = defaultdict(list)
+    stop = False
+    try:
+        for item in items:
+            if item is _STOP_WRITER:
+                stop = True
+            elif not isinstance(item, Event):
+                # one malformed event mustn't take the rest of the batch (or the writer thread) down with it
+                try:
+                    rows_by_pathname[_event_pathname(item)].append(_format_row(item))
+                except Exception:
+                    logger.exception(
+                        f"Encountered an exception formatting event {item}", stack_info=True, exc_info=True
+                    )
+
+        with _open_files_lock:
+            for pathname, rows in rows_by_pathname.items():
+                # likewise, a file that can't be opened or written only loses its own rows
+                try:
+                    _write_rows(_get_open_file(pathname), rows)
+                except Exception:
+                    logger.exception(
+                        f"Encountered an exception writing events to {pathname}", stack_info=True, exc_info=True
+                    )
+    finally:
+        # set flush requests even if something went wrong, so callers of flush_events aren't left waiting
+        for item in items:
+            if isinstance(item, Event):
+                item.set()
+    return stop
+
+
+def _writer_loop() -> None:
+    while True:
+        items = [_event_queue.get()]
+        while len(items) < MAX_BATCH_SIZE:
+            try:
+                items.append(_event_queue.get_nowait())
+            except queue.Empty:
+                break
+        if _write_batch(items):
+            return
+
+
+def _ensure_writer_started() -> None:
+    """Starts the writer thread if it isn't running. Callers must hold _writer_thread_lock."""
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        _writer_thread = Thread(target=_writer_loop, name="event_writer", daemon=True)
+        _writer_thread.start()
+
+
+def _stop_writer() -> None:
+    global _writer_thread
+    with _writer_thread_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            _event_queue.put(_STOP_WRITER)
+            _writer_thread.join()
+        _writer_thread = None
+
+
+def size_open_files_cache() -> int:
+    """
+    Raises the soft open files limit (up to the hard limit) far enough to keep a day's event files open,
+    and sizes the open files cache to fit within it. Returns the new cache size.
+    """
+    global MAX_OPEN_FILES
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = WANTED_OPEN_FILES + RESERVED_FDS
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        raised = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+            soft = raised
+        except (ValueError, OSError):
+            logger.exception(f"Couldn't raise the open files limit from {soft} to {raised}")
+
+    if soft == resource.RLIM_INFINITY:
+        MAX_OPEN_FILES = WANTED_OPEN_FILES
+    else:
+        MAX_OPEN_FILES = max(min(WANTED_OPEN_FILES, soft - RESERVED_FDS), 1)
+    if MAX_OPEN_FILES < WANTED_OPEN_FILES:
+        logger.warning(f"Open files limit is {soft}, so only {MAX_OPEN_FILES} event files can be kept open")
+    return MAX_OPEN_FILES
+
+
+def flush_events() -> None:
+    """Blocks until every event queued so far has been written to its file."""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        flush_request = Event()
+        _event_queue.put(flush_request)
+        flush_request.wait()
+
+
+@atexit.register
+def close_event_files() -> None:
+    """
+    Writes out any queued events, then stops the writer and closes all open event files.
+    Events can't be written after this; write_event raises rather than starting another writer.
+    """
+    global _closed
+    with _writer_thread_lock:
+        _closed = True
+    _stop_writer()
+    with _open_files_lock:
+        for fd in _open_files.values():
+            os.close(fd)
+        _open_files.clear()
+
+
+def write_event(event: dict):
+    """
+    Queues an event to be appended to its stop's events.csv by the writer thread.
+    Raises once the event files are closed, so the caller doesn't go on as if the event was written
+    (process_event would otherwise save a trip state that keeps the event from being detected again after a restart).
+    """
+    # held while queueing, so an event can't be queued behind the writer's stop request and silently lost
+    with _writer_thread_lock:
+        if _closed:
+            raise RuntimeError(f"Event files are closed, so this event can't be written: {event}")
+        _ensure_writer_started()
+        _event_queue.put(event)
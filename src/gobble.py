@@ -1,4 +1,6 @@
 import json
+import os
+import signal
 import threading
 import requests
 import sseclient
@@ -6,13 +8,15 @@ import time
 import logging
 import traceback
 from ddtrace import tracer
+from requests.adapters import HTTPAdapter
 from typing import Set
 
 from constants import ROUTES_BUS, ROUTES_CR, ROUTES_RAPID
 from config import CONFIG
 from event import process_event
 from logger import set_up_logging
-from trip_state import TripsStateManager
+from trip_state import TripsStateManager, flush_trips_states
+import disk
 import gtfs
 
 logging.basicConfig(level=logging.INFO, filename="gobble.log")
@@ -21,8 +25,26 @@ tracer.enabled = CONFIG["DATADOG_TRACE_ENABLED"]
 API_KEY = CONFIG["mbta"]["v3_api_key"]
 HEADERS = {"X-API-KEY": API_KEY, "Accept": "text/event-stream"}
 
+# shared by every client thread, so reconnects can reuse pooled connections to the API.
+# each thread holds one streaming connection open, so the pool has room for all of them
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+
+def handle_sigterm(signum, frame):
+    # atexit handlers don't run when we're killed by a signal, so write out buffered events and trip states first.
+    # once the event files are closed, process_event raises before updating a trip's state, so the states saved
+    # here never run ahead of the events that were written
+    disk.close_event_files()
+    flush_trips_states()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
 
 def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    disk.size_open_files_cache()
+
     # Start downloading GTFS bundles immediately
     gtfs.start_watching_gtfs()
 
@@ -42,8 +64,9 @@ def main():
     cr_thread.start()
 
     bus_threads: list[threading.Thread] = []
-    for i in range(0, len(list(ROUTES_BUS)), 10):
-        routes_bus_chunk = list(ROUTES_BUS)[i : i + 10]
+    routes_bus = list(ROUTES_BUS)
+    for i in range(0, len(routes_bus), 10):
+        routes_bus_chunk = routes_bus[i : i + 10]
         bus_thread = threading.Thread(
             target=client_thread,
             args=(set(routes_bus_chunk),),
@@ -61,7 +84,7 @@ def main():
 def connect(routes: Set[str]) -> requests.Response:
     url = f'https://api-v3.mbta.com/vehicles?filter[route]={",".join(routes)}'
     logger.info(f"Connecting to {url}...")
-    return requests.get(url, headers=HEADERS, stream=True)
+    return SESSION.get(url, headers=HEADERS, stream=True)
 
 
 def client_thread(routes: Set[str]):
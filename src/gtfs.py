@@ -1,17 +1,22 @@
 import datetime
+import math
+import numpy as np
 import pandas as pd
 import pathlib
 import shutil
+import sys
 import urllib.request
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 from dataclasses import dataclass
 from ddtrace import tracer
 from threading import Lock, Thread
-from typing import List, Dict, Optional, Set
+from typing import List, Dict, Optional, Set, Tuple
 
 from config import CONFIG
-from constants import ALL_ROUTES
+from constants import ALL_ROUTES, BUS_ROUTE_STOPS, ROUTES_RAIL
 from logger import set_up_logging
 from util import EASTERN_TIME
 
@@ -31,19 +36,85 @@ GTFS_ARCHIVES_FILENAME = "archived_feeds.txt"
 RTE_DIR_STOP = ["route_id", "direction_id", "stop_id"]
 
 # only fetch required columns from gtfs csv's to reduce memory usage
-STOP_TIMES_COLS = ["stop_id", "trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"]
+STOP_TIMES_COLS = ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"]
+# the only files we read out of each archive; everything else (shapes.txt, etc) is left in the zip
+GTFS_MEMBERS = ["calendar.txt", "calendar_dates.txt", "stops.txt", "trips.txt", "stop_times.txt"]
+TRIPS_COLS = ["route_id", "service_id", "trip_id", "direction_id"]
+# kept on the trips frame when an archive has it, but optional in GTFS, so its absence mustn't fail the read
+OPTIONAL_TRIPS_COLS = ["trip_headsign"]
+STOPS_COLS = ["stop_id", "stop_name"]
 
 
 def _group_df_by_column(df: pd.DataFrame, column_name: str) -> Dict[str, pd.DataFrame]:
     return {key: df_group for key, df_group in df.groupby(column_name)}
 
 
+def _intern_column(series: pd.Series) -> pd.Series:
+    """Share one str object per distinct id; ids repeat across hundreds of thousands of stop_times rows."""
+    return series.map(sys.intern, na_action="ignore")
+
+
 def _get_empty_df_with_same_columns(df: pd.DataFrame) -> pd.DataFrame:
     empty_df = df.copy(deep=False)
     empty_df.drop(empty_df.index, inplace=True)
     return empty_df
 
 
+def _scheduled_stops_for_route(route_trips: pd.DataFrame, route_stop_times: pd.DataFrame) -> pd.DataFrame:
+    """All scheduled stops on a route in arrival order, with their scheduled headway and traveltime."""
+    # take only the stops from those trips (adding route and dir info)
+    trip_info = route_trips[["trip_id", "route_id", "direction_id"]]
+    gtfs_stops = route_stop_times.merge(trip_info, on="trip_id", how="right")
+
+    # calculate gtfs headways
+    gtfs_stops = gtfs_stops.sort_values(by="arrival_time")
+    headways = gtfs_stops.groupby(RTE_DIR_STOP).arrival_time.diff()
+    # the first stop of a trip doesnt technically have a real scheduled headway, so we set to empty string
+    headways = headways.fillna("")
+    gtfs_stops["scheduled_headway"] = headways.dt.seconds
+
+    # calculate gtfs traveltimes
+    trip_start_times = gtfs_stops.groupby("trip_id").arrival_time.transform("min")
+    gtfs_stops["scheduled_tt"] = (gtfs_stops.arrival_time - trip_start_times).dt.seconds
+    return gtfs_stops
+
+
+@dataclass
+class StopSchedule:
+    """The scheduled stops of one route at one stop in one direction, in arrival order."""
+
+    # nanoseconds since midnight of the service date, ascending
+    arrival_times: np.ndarray
+    scheduled_headways: np.ndarray
+    # scheduled traveltime to this stop of each stop's trip (its first visit, if it stops here twice)
+    scheduled_tts: np.ndarray
+
+
+def _build_stop_schedules(
+    route_id: str, route_trips: pd.DataFrame, route_stop_times: pd.DataFrame
+) -> Dict[Tuple, StopSchedule]:
+    gtfs_stops = _scheduled_stops_for_route(route_trips, route_stop_times)
+    # trips without stop times have no stop to match against
+    gtfs_stops = gtfs_stops[gtfs_stops.stop_id.notna()]
+    # events are only ever written for stored stops, so don't build schedules for the rest of a bus route's stops.
+    # (after the headways and traveltimes are calculated, since those depend on every stop of the route)
+    if route_id not in ROUTES_RAIL:
+        gtfs_stops = gtfs_stops[[(route_id, stop_id) in BUS_ROUTE_STOPS for stop_id in gtfs_stops.stop_id]]
+
+    stop_schedules = {}
+    # groups keep their rows in arrival order. kept as numpy arrays rather than lists, since there's one of these for
+    # every stop on every route, for as long as the archive is loaded
+    for (direction_id, stop_id), stops in gtfs_stops.groupby(["direction_id", "stop_id"], sort=False):
+        first_visits = ~stops.trip_id.duplicated()
+        first_visit_tts = stops.scheduled_tt[first_visits].set_axis(stops.trip_id[first_visits])
+        stop_schedules[(direction_id, stop_id)] = StopSchedule(
+            arrival_times=stops.arrival_time.to_numpy(dtype="timedelta64[ns]").view("int64"),
+            scheduled_headways=stops.scheduled_headway.to_numpy(dtype=float),
+            scheduled_tts=stops.trip_id.map(first_visit_tts).to_numpy(),
+        )
+    return stop_schedules
+
+
 @dataclass
 class GtfsArchive:
     # All trips on all routes
@@ -59,17 +130,36 @@ class GtfsArchive:
         self._trips_empty = _get_empty_df_with_same_columns(self.trips)
         self._stop_times_empty = _get_empty_df_with_same_columns(self.stop_times)
         self._trips_by_route_id = _group_df_by_column(self.trips, "route_id")
-        self._stop_times_by_route_id = {}
-        for route_id in self._trips_by_route_id.keys():
-            trip_ids_for_route = self._trips_by_route_id[route_id].trip_id
-            self._stop_times_by_route_id[route_id] = self.stop_times[self.stop_times.trip_id.isin(trip_ids_for_route)]
+        # label every stop time with its route in one pass, instead of scanning all stop times once per route
+        route_id_by_trip_id = self.trips.drop_duplicates("trip_id").set_index("trip_id").route_id
+        stop_times_route_ids = self.stop_times.trip_id.map(route_id_by_trip_id)
+        # only the row positions are kept, not a copy of each route's stop times, so the archive holds them just once
+        self._stop_time_rows_by_route_id = self.stop_times.groupby(stop_times_route_ids).indices
+        # the first row wins if a stop id is listed twice
+        unique_stops = self.stops.drop_duplicates("stop_id")
+        self._stop_names_by_id = dict(zip(unique_stops.stop_id, unique_stops.stop_name))
+        # built up front, so it's the archive loader (the gtfs watcher thread) that pays for the merges and sorts,
+        # not the first event on each route
+        self._stop_schedules_by_route_id: Dict[str, Dict[Tuple, StopSchedule]] = {
+            route_id: _build_stop_schedules(route_id, route_trips, self.stop_times_by_route_id(route_id))
+            for route_id, route_trips in self._trips_by_route_id.items()
+        }
 
     def stop_times_by_route_id(self, route_id: str):
-        return self._stop_times_by_route_id.get(route_id, self._stop_times_empty)
+        rows = self._stop_time_rows_by_route_id.get(route_id)
+        if rows is None:
+            return self._stop_times_empty
+        return self.stop_times.iloc[rows]
 
     def trips_by_route_id(self, route_id: str):
         return self._trips_by_route_id.get(route_id, self._trips_empty)
 
+    def stop_name(self, stop_id: str) -> Optional[str]:
+        return self._stop_names_by_id.get(stop_id)
+
+    def stop_schedule(self, route_id: str, direction_id: int, stop_id: str) -> Optional[StopSchedule]:
+        return self._stop_schedules_by_route_id.get(route_id, {}).get((direction_id, stop_id))
+
 
 @tracer.wrap()
 def _download_gtfs_archives_list() -> pd.DataFrame:
@@ -79,6 +169,15 @@ def _download_gtfs_archives_list() -> pd.DataFrame:
     return archives_df
 
 
+def _extract_gtfs_members(zip_path: str, extract_dir: pathlib.Path) -> None:
+    """Stream the GTFS files we use out of the archive, rather than unpacking all of it."""
+    extract_dir.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in GTFS_MEMBERS:
+            with archive.open(member) as src, open(extract_dir / member, "wb") as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+
+
 def to_dateint(date: datetime.date) -> int:
     """turn date into 20220615 e.g."""
     return int(str(date).replace("-", ""))
@@ -112,8 +211,11 @@ def get_gtfs_archive(dateint: int):
 
     # else we have to download it
     logger.info(f"Downloading GTFS archive for {dateint}: {archive_url}")
-    zipfile, _ = urllib.request.urlretrieve(archive_url)
-    shutil.unpack_archive(zipfile, extract_dir=(MAIN_DIR / archive_name), format="zip")
+    zip_path, _ = urllib.request.urlretrieve(archive_url)
+    # extract to a temporary dir first so an interrupted extraction isn't mistaken for a complete archive
+    tmp_dir = MAIN_DIR / f"{archive_name}.tmp"
+    _extract_gtfs_members(zip_path, tmp_dir)
+    tmp_dir.rename(MAIN_DIR / archive_name)
     # remove temporary zipfile
     urllib.request.urlcleanup()
 
@@ -155,24 +257,46 @@ def read_gtfs(date: datetime.date, routes_filter: Optional[Set[str]] = None) ->
     logger.info(f"Reading GTFS archive for {date}")
 
     archive_dir = get_gtfs_archive(dateint)
-    services = get_services(date, archive_dir)
 
-    # specify dtypes to avoid warnings
-    trips = pd.read_csv(archive_dir / "trips.txt", dtype={"trip_short_name": str, "block_id": str})
+    # the files are independent, and pandas' C parser releases the GIL while tokenizing, so read them concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # specify dtypes to avoid warnings
+        trips_future = executor.submit(
+            pd.read_csv,
+            archive_dir / "trips.txt",
+            dtype={"route_id": str, "trip_id": str},
+            usecols=lambda column: column in TRIPS_COLS or column in OPTIONAL_TRIPS_COLS,
+        )
+        stops_future = executor.submit(
+            pd.read_csv, archive_dir / "stops.txt", dtype={"stop_id": str}, usecols=STOPS_COLS
+        )
+        stop_times_future = executor.submit(
+            pd.read_csv,
+            archive_dir / "stop_times.txt",
+            dtype={"trip_id": str, "stop_id": str},
+            usecols=STOP_TIMES_COLS,
+        )
+        services = get_services(date, archive_dir)
+
+        trips = trips_future.result()
+        stops = stops_future.result()
+        stop_times = stop_times_future.result()
+
     trips = trips[trips.service_id.isin(services)]
     # filter by routes
     if routes_filter:
         trips = trips[trips.route_id.isin(routes_filter)]
 
-    stops = pd.read_csv(archive_dir / "stops.txt")
-
-    stop_times = pd.read_csv(
-        archive_dir / "stop_times.txt", dtype={"trip_id": str, "stop_id": str}, usecols=STOP_TIMES_COLS
-    )
     stop_times = stop_times[stop_times.trip_id.isin(trips.trip_id)]
     stop_times.arrival_time = pd.to_timedelta(stop_times.arrival_time)
     stop_times.departure_time = pd.to_timedelta(stop_times.departure_time)
 
+    trips = trips.assign(route_id=_intern_column(trips.route_id), trip_id=_intern_column(trips.trip_id))
+    stop_times = stop_times.assign(
+        trip_id=_intern_column(stop_times.trip_id), stop_id=_intern_column(stop_times.stop_id)
+    )
+    stops = stops.assign(stop_id=_intern_column(stops.stop_id))
+
     return GtfsArchive(trips=trips, stop_times=stop_times, stops=stops, service_date=date)
 
 
@@ -266,21 +390,7 @@ def add_gtfs_headways(event_df: pd.DataFrame, all_trips: pd.DataFrame, all_stops
     route_id = event_df.route_id.iloc[0]
     # filter out the trips of interest
     relevant_trips = all_trips[all_trips.route_id == route_id]
-
-    # take only the stops from those trips (adding route and dir info)
-    trip_info = relevant_trips[["trip_id", "route_id", "direction_id"]]
-    gtfs_stops = all_stops.merge(trip_info, on="trip_id", how="right")
-
-    # calculate gtfs headways
-    gtfs_stops = gtfs_stops.sort_values(by="arrival_time")
-    headways = gtfs_stops.groupby(RTE_DIR_STOP).arrival_time.diff()
-    # the first stop of a trip doesnt technically have a real scheduled headway, so we set to empty string
-    headways = headways.fillna("")
-    gtfs_stops["scheduled_headway"] = headways.dt.seconds
-
-    # calculate gtfs traveltimes
-    trip_start_times = gtfs_stops.groupby("trip_id").arrival_time.transform("min")
-    gtfs_stops["scheduled_tt"] = (gtfs_stops.arrival_time - trip_start_times).dt.seconds
+    gtfs_stops = _scheduled_stops_for_route(relevant_trips, all_stops)
 
     # assign each actual timepoint a scheduled headway
     # merge_asof 'backward' matches the previous scheduled value of 'arrival_time'
@@ -320,6 +430,43 @@ def add_gtfs_headways(event_df: pd.DataFrame, all_trips: pd.DataFrame, all_stops
     return augmented_event
 
 
+def add_gtfs_headways_to_event(event: dict, gtfs_archive: GtfsArchive) -> dict:
+    """
+    Single-event counterpart of add_gtfs_headways, for the realtime path: sets the event's scheduled_headway
+    and scheduled_tt in place, matching them the same way the merge_asofs there do, without building dataframes.
+    Unmatched values are NaN, as they are there.
+    """
+    scheduled_headway = math.nan
+    scheduled_tt = math.nan
+    stop_schedule = gtfs_archive.stop_schedule(event["route_id"], event["direction_id"], event["stop_id"])
+    if stop_schedule is not None:
+        arrival_times = stop_schedule.arrival_times
+        service_date_start = datetime.datetime.combine(event["service_date"], datetime.time(), tzinfo=EASTERN_TIME)
+        # subtract in utc so the difference is exact across a dst change, as it is in pandas.
+        # (aware datetimes sharing a tzinfo are subtracted as wall times.) in nanoseconds, like arrival_times
+        since_start = event["event_time"].astimezone(datetime.timezone.utc) - service_date_start
+        arrival_time = since_start // datetime.timedelta(microseconds=1) * 1000
+
+        # 'backward': the previous scheduled arrival
+        after = int(np.searchsorted(arrival_times, arrival_time, side="right"))
+        if after:
+            scheduled_headway = stop_schedule.scheduled_headways[after - 1].item()
+
+        # 'nearest': the closer of the previous and next scheduled arrival, preferring the previous on a tie
+        scheduled = after - 1
+        following = int(np.searchsorted(arrival_times, arrival_time, side="left"))
+        if following < len(arrival_times) and (
+            scheduled < 0 or arrival_times[following] - arrival_time < arrival_time - arrival_times[scheduled]
+        ):
+            scheduled = following
+        if scheduled >= 0:
+            scheduled_tt = stop_schedule.scheduled_tts[scheduled].item()
+
+    event["scheduled_headway"] = scheduled_headway
+    event["scheduled_tt"] = scheduled_tt
+    return event
+
+
 current_gtfs_archive = None
 write_gtfs_archive_lock = Lock()
 
@@ -1,9 +1,13 @@
 import datetime
 import glob
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import gzip
+import json
 import os
+import shutil
 import time
 from ddtrace import tracer
 import logging
@@ -16,12 +20,36 @@ from util import EASTERN_TIME, service_date
 logging.basicConfig(level=logging.INFO, filename="s3_upload.log")
 tracer.enabled = CONFIG["DATADOG_TRACE_ENABLED"]
 
-s3 = boto3.client("s3")
-
 S3_BUCKET = "tm-mbta-performance"
 
 LOCAL_DATA_TEMPLATE = str(DATA_DIR / "daily-*/*/Year={year}/Month={month}/Day={day}/events.csv")
 S3_DATA_TEMPLATE = "Events-live/{relative_path}.gz"
+# uploads are network-bound and independent, so several run at once (boto3 clients are thread-safe)
+UPLOAD_WORKERS = 16
+# one pooled connection per worker; botocore's default pool of 10 would throw away and rebuild the rest
+s3 = boto3.client("s3", config=Config(max_pool_connections=UPLOAD_WORKERS))
+# records the (mtime, size) of each file as of its last upload, so unchanged files can be skipped
+UPLOAD_STATE_PATH = DATA_DIR / "s3_upload_state.json"
+
+
+def _file_signature(fp: str) -> list[int]:
+    stat = os.stat(fp)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _read_upload_state() -> dict[str, list[int]]:
+    if UPLOAD_STATE_PATH.exists():
+        with open(UPLOAD_STATE_PATH, "r") as state_file:
+            try:
+                return json.load(state_file)
+            except json.decoder.JSONDecodeError:
+                pass
+    return {}
+
+
+def _write_upload_state(upload_state: dict[str, list[int]]) -> None:
+    with open(UPLOAD_STATE_PATH, "w") as state_file:
+        state_file.write(json.dumps(upload_state))
 
 
 @tracer.wrap()
@@ -32,9 +60,11 @@ def _compress_and_upload_file(fp: str):
     s3_key = S3_DATA_TEMPLATE.format(relative_path=rp)
 
     with open(fp, "rb") as f:
-        # gzip to buffer and upload
-        gz_bytes = gzip.compress(f.read())
-        buffer = BytesIO(gz_bytes)
+        # stream through gzip into the buffer, so only the compressed bytes are ever held in memory
+        buffer = BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as gz:
+            shutil.copyfileobj(f, gz, length=1 << 20)
+        buffer.seek(0)
 
         s3.upload_fileobj(
             buffer, S3_BUCKET, Key=s3_key, ExtraArgs={"ContentType": "text/csv", "ContentEncoding": "gzip"}
@@ -49,18 +79,30 @@ def upload_todays_events_to_s3():
     logger.info("Beginning upload of recent events to s3.")
     pull_date = service_date(datetime.datetime.now(EASTERN_TIME))
 
-    # get files updated for this service date
-    # TODO: only update modified files? cant imagine much of a difference if we partition live data by day
-    files_updated_today = glob.glob(
-        LOCAL_DATA_TEMPLATE.format(year=pull_date.year, month=pull_date.month, day=pull_date.day)
-    )
-
-    # upload them to s3, gzipped
-    for fp in files_updated_today:
-        _compress_and_upload_file(fp)
+    # upload files updated for this service date to s3, gzipped, skipping any that haven't changed since the last
+    # upload. uploads are submitted as the glob finds files, so they start before the whole tree has been walked.
+    # only today's files are carried over, so the state file doesn't grow from day to day.
+    previous_upload_state = _read_upload_state()
+    upload_state = {}
+    uploads = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        for fp in glob.iglob(LOCAL_DATA_TEMPLATE.format(year=pull_date.year, month=pull_date.month, day=pull_date.day)):
+            # take the signature before reading, so a concurrent append is picked up on the next run
+            signature = _file_signature(fp)
+            if previous_upload_state.get(fp) != signature:
+                uploads.append(executor.submit(_compress_and_upload_file, fp))
+            upload_state[fp] = signature
+
+        # wait on the results so any upload failure is raised here, before the new state is recorded
+        for upload in uploads:
+            upload.result()
+    _write_upload_state(upload_state)
 
     end_time = time.time()
-    logger.info(f"Uploaded {len(files_updated_today)} files to s3, took {end_time - start_time} seconds.")
+    logger.info(
+        f"Uploaded {len(uploads)} files to s3 ({len(upload_state) - len(uploads)} unchanged), "
+        f"took {end_time - start_time} seconds."
+    )
 
 
 if __name__ == "__main__":
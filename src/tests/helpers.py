@@ -0,0 +1,19 @@
+import pathlib
+import tempfile
+from types import ModuleType
+from unittest import TestCase, mock
+
+
+def temp_data_dir(testcase: TestCase, *modules: ModuleType, attribute: str = "DATA_DIR") -> pathlib.Path:
+    """
+    Points each module's data dir at a new temporary directory for the rest of the test, and returns it.
+    The directory is removed and the modules restored when the test finishes.
+    """
+    temp_dir = tempfile.TemporaryDirectory()
+    testcase.addCleanup(temp_dir.cleanup)
+    data_dir = pathlib.Path(temp_dir.name)
+    for module in modules:
+        patcher = mock.patch.object(module, attribute, data_dir)
+        patcher.start()
+        testcase.addCleanup(patcher.stop)
+    return data_dir
@@ -0,0 +1,137 @@
+import csv
+import datetime
+import io
+import resource
+from unittest import TestCase, mock
+from zoneinfo import ZoneInfo
+
+import disk
+from tests.helpers import temp_data_dir
+
+
+def _event(**overrides) -> dict:
+    event = {
+        "service_date": datetime.date(2024, 1, 4),
+        "route_id": "1",
+        "trip_id": "60063977",
+        "direction_id": 0,
+        "stop_id": "10003",
+        "stop_sequence": 5,
+        "vehicle_id": "0",
+        "vehicle_label": "1234",
+        "event_type": "ARR",
+        "event_time": datetime.datetime(2024, 1, 4, 5, 11, 45, 188670, tzinfo=ZoneInfo(key="US/Eastern")),
+        "scheduled_headway": 900.0,
+        "scheduled_tt": 180,
+    }
+    event.update(overrides)
+    return event
+
+
+def _dict_writer_rows(events: list) -> str:
+    """What csv.DictWriter wrote for these events, header included"""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=disk.CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(events)
+    return out.getvalue()
+
+
+class TestDisk(TestCase):
+    def setUp(self):
+        self.data_dir = temp_data_dir(self, disk)
+        # cached paths are built from DATA_DIR
+        disk._events_csv_pathname.cache_clear()
+        # each test starts with the event files open again, and closes them when it's done
+        closed_patcher = mock.patch.object(disk, "_closed", False)
+        closed_patcher.start()
+        self.addCleanup(closed_patcher.stop)
+        self.addCleanup(disk.close_event_files)
+
+    def _close_and_reopen(self):
+        """Closes every event file as gobble does at shutdown, but lets the test go on writing events"""
+        disk.close_event_files()
+        disk._closed = False
+
+    def test_write_event_matches_dict_writer(self):
+        events = [
+            _event(),
+            _event(vehicle_label='12,"34"', scheduled_headway=float("nan")),
+            _event(scheduled_headway=None, extra_field="ignored"),
+            {key: value for key, value in _event().items() if key != "scheduled_tt"},
+        ]
+        for event in events:
+            disk.write_event(event)
+        disk.close_event_files()
+
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows(events)
+
+    def test_write_event_appends_without_second_header(self):
+        disk.write_event(_event())
+        self._close_and_reopen()
+        disk.write_event(_event(event_type="DEP"))
+        disk.close_event_files()
+
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows([_event(), _event(event_type="DEP")])
+
+    def test_removed_file_is_recreated_with_header(self):
+        disk.write_event(_event())
+        self._close_and_reopen()
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        pathname.unlink()
+        disk.write_event(_event(event_type="DEP"))
+        disk.close_event_files()
+
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows([_event(event_type="DEP")])
+
+    def test_write_event_after_close_raises(self):
+        disk.write_event(_event())
+        disk.close_event_files()
+
+        with self.assertRaises(RuntimeError):
+            disk.write_event(_event(event_type="DEP"))
+        # no new writer was started for it
+        assert disk._writer_thread is None
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows([_event()])
+
+    def test_malformed_event_does_not_lose_the_rest_of_its_batch(self):
+        disk.write_event(_event())
+        disk.write_event(_event(event_time=None))
+        disk.write_event(_event(event_type="DEP"))
+        disk.flush_events()
+
+        assert disk._writer_thread.is_alive()
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows([_event(), _event(event_type="DEP")])
+
+    def test_flush_events_makes_queued_events_visible(self):
+        disk.write_event(_event())
+        disk.flush_events()
+
+        pathname = self.data_dir / "daily-bus-data/1-0-10003/Year=2024/Month=1/Day=4" / disk.CSV_FILENAME
+        with open(pathname, newline="") as fd:
+            assert fd.read() == _dict_writer_rows([_event()])
+
+    def test_size_open_files_cache(self):
+        wanted = disk.WANTED_OPEN_FILES + disk.RESERVED_FDS
+        # restores MAX_OPEN_FILES afterwards
+        with mock.patch.object(disk, "MAX_OPEN_FILES", disk.MAX_OPEN_FILES), mock.patch.object(
+            resource, "getrlimit", return_value=(1024, 524288)
+        ), mock.patch.object(resource, "setrlimit") as setrlimit:
+            assert disk.size_open_files_cache() == disk.WANTED_OPEN_FILES
+            setrlimit.assert_called_once_with(resource.RLIMIT_NOFILE, (wanted, 524288))
+
+        # the soft limit can't be raised past the hard limit, so the cache is sized to fit within it
+        with mock.patch.object(disk, "MAX_OPEN_FILES", disk.MAX_OPEN_FILES), mock.patch.object(
+            resource, "getrlimit", return_value=(1024, 4096)
+        ), mock.patch.object(resource, "setrlimit") as setrlimit:
+            assert disk.size_open_files_cache() == 4096 - disk.RESERVED_FDS
+            setrlimit.assert_called_once_with(resource.RLIMIT_NOFILE, (4096, 4096))
@@ -0,0 +1,154 @@
+import datetime
+import pathlib
+from typing import Optional
+from unittest import TestCase, mock
+
+import pandas as pd
+
+from trip_state import TripState
+from util import EASTERN_TIME
+
+import disk
+import event
+import gtfs
+
+DATA_DIR = pathlib.Path("./src/tests/sample_data")
+
+ROUTE_ID = "1"
+TRIP_ID = "60063977"
+# 10590 is one of the route 1 stops we store, 10003 isn't
+STORED_STOP_ID = "10590"
+UNSTORED_STOP_ID = "10003"
+
+
+class StubTripsStateManager:
+    """Keeps trip states in memory, rather than writing them to disk like TripsStateManager does"""
+
+    def __init__(self, trip_states: Optional[dict] = None):
+        self.trip_states = trip_states or {}
+
+    def get_trip_state(self, route_id: str, trip_id: str) -> Optional[TripState]:
+        return self.trip_states.get((route_id, trip_id))
+
+    def set_trip_state(self, route_id: str, trip_id: str, trip_state: TripState) -> None:
+        self.trip_states[(route_id, trip_id)] = trip_state
+
+
+def _update(current_status: str, stop_id: str, stop_sequence: int, updated_at: str) -> dict:
+    return {
+        "attributes": {
+            "current_status": current_status,
+            "current_stop_sequence": stop_sequence,
+            "direction_id": 0,
+            "label": "1234",
+            "updated_at": updated_at,
+        },
+        "relationships": {
+            "route": {"data": {"id": ROUTE_ID}},
+            "stop": {"data": {"id": stop_id}},
+            "trip": {"data": {"id": TRIP_ID}},
+        },
+    }
+
+
+def _trip_state(stop_id: str, stop_sequence: int, event_type: str) -> TripState:
+    return TripState(
+        stop_sequence=stop_sequence,
+        stop_id=stop_id,
+        updated_at=datetime.datetime(2024, 1, 4, 5, 10, 0, tzinfo=EASTERN_TIME),
+        event_type=event_type,
+    )
+
+
+class TestProcessEvent(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        stop_times = pd.read_csv(
+            DATA_DIR / "stops_times_mini.txt", dtype={"trip_id": str, "stop_id": str}, usecols=gtfs.STOP_TIMES_COLS
+        )
+        stop_times.arrival_time = pd.to_timedelta(stop_times.arrival_time)
+        stop_times.departure_time = pd.to_timedelta(stop_times.departure_time)
+        trips = pd.read_csv(DATA_DIR / "trips_mini.txt", dtype={"route_id": str, "trip_id": str})
+        cls.gtfs_archive = gtfs.GtfsArchive(
+            trips=trips,
+            stop_times=stop_times,
+            stops=pd.DataFrame({"stop_id": [STORED_STOP_ID], "stop_name": ["Massachusetts Avenue @ Newbury St"]}),
+            service_date=datetime.date(2024, 1, 4),
+        )
+
+    def setUp(self):
+        get_archive_patcher = mock.patch.object(gtfs, "get_current_gtfs_archive", return_value=self.gtfs_archive)
+        self.get_current_gtfs_archive = get_archive_patcher.start()
+        self.addCleanup(get_archive_patcher.stop)
+        write_event_patcher = mock.patch.object(disk, "write_event")
+        self.write_event = write_event_patcher.start()
+        self.addCleanup(write_event_patcher.stop)
+
+    def _written_event(self) -> dict:
+        self.write_event.assert_called_once()
+        return self.write_event.call_args.args[0]
+
+    def test_first_update_for_trip_writes_nothing(self):
+        trips_state = StubTripsStateManager()
+        event.process_event(
+            _update("STOPPED_AT", STORED_STOP_ID, 8, "2024-01-04T05:12:30-05:00"),
+            trips_state,
+        )
+
+        self.write_event.assert_not_called()
+        assert trips_state.get_trip_state(ROUTE_ID, TRIP_ID) == TripState(
+            stop_sequence=8,
+            stop_id=STORED_STOP_ID,
+            updated_at=datetime.datetime.fromisoformat("2024-01-04T05:12:30-05:00"),
+            event_type="ARR",
+        )
+
+    def test_departure_is_written_for_previous_stop(self):
+        trips_state = StubTripsStateManager({(ROUTE_ID, TRIP_ID): _trip_state(STORED_STOP_ID, 8, "ARR")})
+        event.process_event(_update("IN_TRANSIT_TO", "87", 9, "2024-01-04T05:12:30-05:00"), trips_state)
+
+        written = self._written_event()
+        assert written["event_type"] == "DEP"
+        assert written["stop_id"] == STORED_STOP_ID
+        assert written["stop_sequence"] == 9
+        assert trips_state.get_trip_state(ROUTE_ID, TRIP_ID).event_type == "DEP"
+
+    def test_arrival_after_departure_is_written(self):
+        trips_state = StubTripsStateManager({(ROUTE_ID, TRIP_ID): _trip_state(STORED_STOP_ID, 8, "DEP")})
+        event.process_event(_update("STOPPED_AT", STORED_STOP_ID, 8, "2024-01-04T05:12:30-05:00"), trips_state)
+
+        written = self._written_event()
+        assert written["event_type"] == "ARR"
+        assert written["stop_id"] == STORED_STOP_ID
+        assert trips_state.get_trip_state(ROUTE_ID, TRIP_ID).event_type == "ARR"
+
+    def test_unstored_bus_stop_skips_gtfs(self):
+        trips_state = StubTripsStateManager({(ROUTE_ID, TRIP_ID): _trip_state(UNSTORED_STOP_ID, 5, "ARR")})
+        event.process_event(_update("IN_TRANSIT_TO", "57", 6, "2024-01-04T05:10:30-05:00"), trips_state)
+
+        self.get_current_gtfs_archive.assert_not_called()
+        self.write_event.assert_not_called()
+        # the state still moves on to the next stop
+        assert trips_state.get_trip_state(ROUTE_ID, TRIP_ID).stop_sequence == 6
+
+    def test_stored_stop_event_is_enriched(self):
+        trips_state = StubTripsStateManager({(ROUTE_ID, TRIP_ID): _trip_state(STORED_STOP_ID, 8, "DEP")})
+        # updated_at in utc, to check it's written in eastern time
+        event.process_event(_update("STOPPED_AT", STORED_STOP_ID, 8, "2024-01-04T10:12:30+00:00"), trips_state)
+
+        written = self._written_event()
+        assert written == {
+            "service_date": datetime.date(2024, 1, 4),
+            "route_id": ROUTE_ID,
+            "trip_id": TRIP_ID,
+            "direction_id": 0,
+            "stop_id": STORED_STOP_ID,
+            "stop_sequence": 8,
+            "vehicle_id": "0",
+            "vehicle_label": "1234",
+            "event_type": "ARR",
+            "event_time": datetime.datetime(2024, 1, 4, 5, 12, 30, tzinfo=EASTERN_TIME),
+            "scheduled_headway": 900.0,
+            "scheduled_tt": 300,
+        }
+        assert written["event_time"].tzinfo == EASTERN_TIME
@@ -4,10 +4,15 @@ import numpy as np
 import pandas as pd
 import pathlib
 import shutil
+import urllib.request
+import zipfile
+from unittest import mock
 from zoneinfo import ZoneInfo
 from util import to_dateint
 
+import event
 import gtfs
+from tests.helpers import temp_data_dir
 
 DATA_DIR = pathlib.Path("./src/tests/sample_data")
 
@@ -187,6 +192,86 @@ class TestGTFS(unittest.TestCase):
         post_df = gtfs.add_gtfs_headways(df, self.all_trips, self.stop_times)
         pd.testing.assert_frame_equal(post_df, expected_df)
 
+    def test_add_gtfs_headways_to_event(self):
+        # 10003 isn't one of the route 1 stops we store, but it's the stop the dataframe tests above match against
+        with mock.patch.object(gtfs, "BUS_ROUTE_STOPS", gtfs.BUS_ROUTE_STOPS | {("1", "10003")}):
+            archive = gtfs.GtfsArchive(
+                trips=self.all_trips,
+                stop_times=self.stop_times,
+                stops=pd.DataFrame({"stop_id": [], "stop_name": []}),
+                service_date=datetime.date(2024, 1, 4),
+            )
+        event = {
+            "service_date": datetime.date(2024, 1, 4),
+            "route_id": "1",
+            "trip_id": "60063977",
+            "direction_id": 0,
+            "stop_id": "10003",
+            "stop_sequence": 5,
+            "vehicle_id": "0",
+            "vehicle_label": "catbus",
+            "event_type": "ARR",
+        }
+
+        # on time, slightly late
+        on_time = datetime.datetime(2024, 1, 4, 5, 11, 45, 188670, tzinfo=ZoneInfo(key="US/Eastern"))
+        post_event = gtfs.add_gtfs_headways_to_event({**event, "event_time": on_time}, archive)
+        assert post_event["scheduled_headway"] == 900.0
+        assert post_event["scheduled_tt"] == 180
+
+        # very late: so late that we use the next stop for headway calcs
+        very_late = datetime.datetime(2024, 1, 4, 5, 26, 45, 188670, tzinfo=ZoneInfo(key="US/Eastern"))
+        post_event = gtfs.add_gtfs_headways_to_event({**event, "event_time": very_late}, archive)
+        assert post_event["scheduled_headway"] == 900.0
+        assert post_event["scheduled_tt"] == 180
+
+        # so early youve made the prior bus
+        very_early = datetime.datetime(2024, 1, 4, 4, 45, 45, 188670, tzinfo=ZoneInfo(key="US/Eastern"))
+        post_event = gtfs.add_gtfs_headways_to_event({**event, "event_time": very_early}, archive)
+        assert np.isnan(post_event["scheduled_headway"])
+        assert post_event["scheduled_tt"] == 180
+
+        # a stop that isn't on the schedule
+        post_event = gtfs.add_gtfs_headways_to_event({**event, "stop_id": "nope", "event_time": on_time}, archive)
+        assert np.isnan(post_event["scheduled_headway"])
+        assert np.isnan(post_event["scheduled_tt"])
+
+    def test_stop_schedules_only_built_for_stored_stops(self):
+        archive = gtfs.GtfsArchive(
+            trips=self.all_trips,
+            stop_times=self.stop_times,
+            stops=pd.DataFrame({"stop_id": [], "stop_name": []}),
+            service_date=datetime.date(2024, 1, 4),
+        )
+        # stored bus stop
+        assert archive.stop_schedule("1", 0, "10590") is not None
+        # bus stop we don't store
+        assert archive.stop_schedule("1", 0, "10003") is None
+        # every rail stop is stored
+        cr_trips = self.all_trips[self.all_trips.route_id == "CR-Providence"]
+        cr_stops = self.stop_times.merge(cr_trips[["trip_id", "direction_id"]], on="trip_id")
+        for direction_id, stop_id in zip(cr_stops.direction_id, cr_stops.stop_id):
+            assert archive.stop_schedule("CR-Providence", direction_id, stop_id) is not None
+
+    def test_stop_name(self):
+        archive = gtfs.GtfsArchive(
+            trips=self.all_trips,
+            stop_times=self.stop_times,
+            stops=pd.DataFrame(
+                {
+                    "stop_id": ["10003", "10590", "10003"],
+                    "stop_name": ["Albany St @ Randolph St", "Massachusetts Ave @ Newbury St", "Albany St"],
+                }
+            ),
+            service_date=datetime.date(2024, 1, 4),
+        )
+        assert archive.stop_name("10590") == "Massachusetts Ave @ Newbury St"
+        # the first row wins if a stop id is listed twice
+        assert archive.stop_name("10003") == "Albany St @ Randolph St"
+        # unknown stops have no name, so get_stop_name falls back to the raw id
+        assert archive.stop_name("ER-0117-01") is None
+        assert event.get_stop_name(archive, "ER-0117-01") == "ER-0117-01"
+
     # this is really more of an integration test... should we have an integration tests directory?
     def test_get_gtfs_archive_day_is_feed_returns_dir_of_day(self):
         # just a random day
@@ -241,3 +326,36 @@ class TestGTFS(unittest.TestCase):
         assert "Harvard" in result.trips_by_route_id("1")["trip_headsign"].values
 
         shutil.rmtree(expected_path)
+
+    def test_read_gtfs_without_trip_headsign(self):
+        main_dir = temp_data_dir(self, gtfs, attribute="MAIN_DIR")
+        (main_dir / gtfs.GTFS_ARCHIVES_FILENAME).write_text(
+            "feed_start_date,feed_end_date,archive_url\n20240101,20240131,https://cdn.mbta.com/archive/20240101.zip\n"
+        )
+        # trip_headsign is optional in gtfs, and some archives leave it out
+        gtfs_files = {
+            "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+            "weekday,1,1,1,1,1,0,0,20240101,20240131\n",
+            "calendar_dates.txt": "service_id,date,exception_type\n",
+            "stops.txt": "stop_id,stop_name,stop_lat\n10003,Albany St @ Randolph St,42.34\n",
+            "trips.txt": "route_id,service_id,trip_id,direction_id\n1,weekday,60063977,0\n",
+            "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+            "60063977,05:10:00,05:10:00,10003,5\n",
+            "shapes.txt": "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n010070,42.37,-71.12,10001\n",
+        }
+        zip_path = main_dir / "download.zip"
+        with zipfile.ZipFile(zip_path, "w") as archive:
+            for name, contents in gtfs_files.items():
+                archive.writestr(name, contents)
+
+        with mock.patch.object(urllib.request, "urlretrieve", return_value=(str(zip_path), None)):
+            result = gtfs.read_gtfs(datetime.date(2024, 1, 4))
+
+        assert result.trips.trip_id.tolist() == ["60063977"]
+        assert "trip_headsign" not in result.trips.columns
+        assert result.stop_times_by_route_id("1").stop_id.tolist() == ["10003"]
+        assert result.stop_name("10003") == "Albany St @ Randolph St"
+
+        # only the files we read were extracted, and the temporary extraction dir was renamed into place
+        assert sorted(path.name for path in (main_dir / "20240101").iterdir()) == sorted(gtfs.GTFS_MEMBERS)
+        assert not (main_dir / "20240101.tmp").exists()
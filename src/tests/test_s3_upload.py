@@ -0,0 +1,73 @@
+import datetime
+import json
+import logging
+from unittest import TestCase, mock
+
+from util import EASTERN_TIME, service_date
+from tests.helpers import temp_data_dir
+
+# s3_upload points the root logger at s3_upload.log in the working directory when it's imported
+with mock.patch.object(logging, "basicConfig"):
+    import s3_upload
+
+
+class TestUploadTodaysEventsToS3(TestCase):
+    def setUp(self):
+        self.data_dir = temp_data_dir(self, s3_upload)
+        self.upload_state_path = self.data_dir / "s3_upload_state.json"
+
+        local_data_template = str(self.data_dir / "daily-*/*/Year={year}/Month={month}/Day={day}/events.csv")
+        for name, value in [
+            ("LOCAL_DATA_TEMPLATE", local_data_template),
+            ("UPLOAD_STATE_PATH", self.upload_state_path),
+        ]:
+            patcher = mock.patch.object(s3_upload, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        s3_patcher = mock.patch.object(s3_upload, "s3")
+        self.s3 = s3_patcher.start()
+        self.addCleanup(s3_patcher.stop)
+
+        today = service_date(datetime.datetime.now(EASTERN_TIME))
+        self.events_paths = []
+        for stop_id in ["10003", "10004"]:
+            dirname = (
+                self.data_dir / f"daily-bus-data/1-0-{stop_id}/Year={today.year}/Month={today.month}/Day={today.day}"
+            )
+            dirname.mkdir(parents=True)
+            (dirname / "events.csv").write_text("service_date,route_id\r\n")
+            self.events_paths.append(dirname / "events.csv")
+
+    def _uploaded_keys(self) -> list:
+        keys = sorted(call.kwargs["Key"] for call in self.s3.upload_fileobj.call_args_list)
+        self.s3.upload_fileobj.reset_mock()
+        return keys
+
+    def test_only_changed_files_are_uploaded_again(self):
+        # an entry from a previous day, which shouldn't be carried over
+        self.upload_state_path.write_text(json.dumps({"data/daily-bus-data/old/events.csv": [0, 0]}))
+
+        s3_upload.upload_todays_events_to_s3()
+        assert len(self._uploaded_keys()) == 2
+        with open(self.upload_state_path) as state_file:
+            assert sorted(json.load(state_file)) == sorted(str(path) for path in self.events_paths)
+
+        s3_upload.upload_todays_events_to_s3()
+        assert self._uploaded_keys() == []
+
+        with open(self.events_paths[0], "a") as events_file:
+            events_file.write("2024-01-04,1\r\n")
+        s3_upload.upload_todays_events_to_s3()
+        assert self._uploaded_keys() == [
+            "Events-live/" + str(self.events_paths[0].relative_to(self.data_dir)) + ".gz",
+        ]
+
+    def test_upload_state_is_not_recorded_if_an_upload_fails(self):
+        self.s3.upload_fileobj.side_effect = Exception("upload failed")
+        with self.assertRaises(Exception):
+            s3_upload.upload_todays_events_to_s3()
+        assert not self.upload_state_path.exists()
+
+        self.s3.upload_fileobj.reset_mock(side_effect=True)
+        s3_upload.upload_todays_events_to_s3()
+        assert len(self._uploaded_keys()) == 2
@@ -0,0 +1,66 @@
+import json
+from datetime import datetime
+from unittest import TestCase, mock
+
+from util import EASTERN_TIME
+
+import trip_state
+from tests.helpers import temp_data_dir
+
+
+def _trip_state(stop_sequence: int) -> trip_state.TripState:
+    return trip_state.TripState(
+        stop_sequence=stop_sequence,
+        stop_id="10003",
+        updated_at=datetime(2024, 1, 4, 5, 11, 45, tzinfo=EASTERN_TIME),
+        event_type="ARR",
+    )
+
+
+class TestRouteTripsState(TestCase):
+    def setUp(self):
+        self.data_dir = temp_data_dir(self, trip_state)
+        # keep the background writer from starting, so only the test decides when states are written
+        flusher_patcher = mock.patch.object(trip_state, "_flusher_thread", mock.Mock())
+        flusher_patcher.start()
+        self.addCleanup(flusher_patcher.stop)
+        # don't leave these behind for the atexit flush, which would write them to the real data dir
+        self.addCleanup(trip_state._route_trips_states.clear)
+        self.state_file_path = self.data_dir / "trip_states" / "1.json"
+
+    def _written_stop_sequence(self) -> int:
+        with open(self.state_file_path) as state_file:
+            return json.load(state_file)["trip_states"]["60063977"]["stop_sequence"]
+
+    def test_set_trip_state_only_writes_on_flush(self):
+        route_trips_state = trip_state.RouteTripsState("1")
+        route_trips_state.set_trip_state("60063977", _trip_state(1))
+        route_trips_state.set_trip_state("60063977", _trip_state(2))
+        assert not self.state_file_path.exists()
+
+        route_trips_state.flush()
+        assert self._written_stop_sequence() == 2
+
+        # nothing has changed, so there's nothing to write
+        self.state_file_path.unlink()
+        route_trips_state.flush()
+        assert not self.state_file_path.exists()
+
+    def test_failed_flush_is_retried(self):
+        route_trips_state = trip_state.RouteTripsState("1")
+        route_trips_state.set_trip_state("60063977", _trip_state(1))
+        with mock.patch.object(trip_state, "write_trips_state_file", side_effect=OSError):
+            with self.assertRaises(OSError):
+                route_trips_state.flush()
+
+        route_trips_state.flush()
+        assert self._written_stop_sequence() == 1
+
+    def test_flush_trips_states_writes_pending_changes(self):
+        route_trips_state = trip_state.RouteTripsState("1")
+        route_trips_state.set_trip_state("60063977", _trip_state(1))
+        trip_state.flush_trips_states()
+        assert self._written_stop_sequence() == 1
+
+        # reloads what was written
+        assert trip_state.RouteTripsState("1").get_trip_state("60063977") == _trip_state(1)
@@ -1,8 +1,10 @@
+import atexit
 import json
+import time
 from datetime import date, datetime
 from dataclasses import dataclass
-from typing import Dict, TypedDict, Optional
-from ddtrace import tracer
+from threading import Lock, Thread
+from typing import Dict, List, Optional
 
 from logger import set_up_logging
 from disk import DATA_DIR
@@ -10,8 +12,18 @@ from util import get_current_service_date
 
 logger = set_up_logging(__name__)
 
+# changed trip states are written to disk by a background thread this often, rather than after every event.
+# the file only has to be fresh enough to pick up where we left off after a restart
+STATE_WRITE_INTERVAL_SECONDS = 1
 
-class TripState(TypedDict):
+# every RouteTripsState, so their pending changes can be written out periodically and at shutdown
+_route_trips_states: List["RouteTripsState"] = []
+_route_trips_states_lock = Lock()
+_flusher_thread: Optional[Thread] = None
+
+
+@dataclass(frozen=True, slots=True)
+class TripState:
     """
     Holds the current state of a single trip
     """
@@ -28,25 +40,29 @@ class TripState(TypedDict):
 
 def serialize_trip_state(trip_state: TripState) -> Dict[str, str]:
     return {
-        **trip_state,
-        "updated_at": trip_state["updated_at"].isoformat(),
+        "stop_sequence": trip_state.stop_sequence,
+        "stop_id": trip_state.stop_id,
+        "updated_at": trip_state.updated_at.isoformat(),
+        "event_type": trip_state.event_type,
     }
 
 
 def deserialize_trip_state(trip_state: Dict[str, str]) -> TripState:
-    return {
-        **trip_state,
-        "updated_at": datetime.fromisoformat(trip_state["updated_at"]),
-    }
+    return TripState(
+        stop_sequence=trip_state["stop_sequence"],
+        stop_id=trip_state["stop_id"],
+        updated_at=datetime.fromisoformat(trip_state["updated_at"]),
+        event_type=trip_state["event_type"],
+    )
 
 
-def write_trips_state_file(route_id: str, state: "RouteTripsState") -> None:
+def write_trips_state_file(route_id: str, service_date: date, trips: Dict[str, TripState]) -> None:
     trips_states_dir = DATA_DIR / "trip_states"
     trips_states_dir.mkdir(exist_ok=True)
     trip_file_path = trips_states_dir / f"{route_id}.json"
-    trip_states = {trip_id: serialize_trip_state(trip_state) for trip_id, trip_state in state.trips.items()}
+    trip_states = {trip_id: serialize_trip_state(trip_state) for trip_id, trip_state in trips.items()}
     file_contents = {
-        "service_date": state.service_date.isoformat(),
+        "service_date": service_date.isoformat(),
         "trip_states": trip_states,
     }
     with open(trip_file_path, "w") as trip_file:
@@ -88,6 +104,14 @@ class RouteTripsState:
     trips: Dict[str, TripState] = None
 
     def __post_init__(self):
+        # guards trips against being copied by another thread while it's changed
+        self._lock = Lock()
+        # serializes writes of the file, so an older copy of trips can't be written over a newer one
+        self._write_lock = Lock()
+        # whether trips has changed since it was last written
+        self._dirty = False
+        _register_route_trips_state(self)
+
         state_file = read_trips_state_file(self.route_id)
         if state_file:
             self.trips = state_file["trip_states"]
@@ -97,26 +121,69 @@ class RouteTripsState:
             self.trips = {}
             self.service_date = get_current_service_date()
 
-    @tracer.wrap()
     def set_trip_state(self, trip_id: str, trip_state: TripState) -> None:
-        self.trips[trip_id] = trip_state
-        write_trips_state_file(self.route_id, self)
+        with self._lock:
+            self.trips[trip_id] = trip_state
+            self._dirty = True
 
-    @tracer.wrap()
     def get_trip_state(self, trip_id: str) -> Optional[TripState]:
         self._purge_trips_state_if_overnight()
-        trip = self.trips.get(trip_id)
-        if trip:
-            return {**trip}
-        return None
+        # trip states are immutable, so there's no need to hand out a copy
+        return self.trips.get(trip_id)
+
+    def flush(self) -> None:
+        """Writes the trip states out if they've changed since they were last written."""
+        with self._write_lock:
+            # copy under the lock, but write outside it, so set_trip_state never waits on the disk
+            with self._lock:
+                if not self._dirty:
+                    return
+                service_date = self.service_date
+                trips = dict(self.trips)
+                self._dirty = False
+            try:
+                write_trips_state_file(self.route_id, service_date, trips)
+            except Exception:
+                # try again on the next flush
+                with self._lock:
+                    self._dirty = True
+                raise
 
     def _purge_trips_state_if_overnight(self) -> None:
         current_service_date = get_current_service_date()
         if self.service_date < current_service_date:
             logger.info(f"Purging trip state for route {self.route_id} on new service date {current_service_date}")
-            self.service_date = current_service_date
-            self.trips = {}
-        write_trips_state_file(self.route_id, self)
+            with self._lock:
+                self.service_date = current_service_date
+                self.trips = {}
+                self._dirty = True
+
+
+@atexit.register
+def flush_trips_states() -> None:
+    """Writes out every route's trip states that have changed since they were last written."""
+    with _route_trips_states_lock:
+        route_trips_states = list(_route_trips_states)
+    for route_trips_state in route_trips_states:
+        route_trips_state.flush()
+
+
+def _flush_trips_states_periodically() -> None:
+    while True:
+        time.sleep(STATE_WRITE_INTERVAL_SECONDS)
+        try:
+            flush_trips_states()
+        except Exception:
+            logger.exception("Encountered an exception writing trip states", stack_info=True, exc_info=True)
+
+
+def _register_route_trips_state(route_trips_state: RouteTripsState) -> None:
+    global _flusher_thread
+    with _route_trips_states_lock:
+        _route_trips_states.append(route_trips_state)
+        if _flusher_thread is None:
+            _flusher_thread = Thread(target=_flush_trips_states_periodically, name="trip_state_writer", daemon=True)
+            _flusher_thread.start()
 
 
 class TripsStateManager:
@@ -2,7 +2,7 @@ from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 import os
 
-from constants import ROUTES_CR, ROUTES_RAPID
+from constants import ROUTE_KIND
 
 EASTERN_TIME = ZoneInfo("US/Eastern")
 
@@ -13,22 +13,24 @@ def to_dateint(date: date) -> int:
 
 
 def output_dir_path(route_id: str, direction_id: str, stop_id: str, ts: datetime) -> str:
-    date = service_date(ts)
+    return service_date_output_dir_path(route_id, direction_id, stop_id, service_date(ts))
+
+
+def service_date_output_dir_path(route_id: str, direction_id: str, stop_id: str, date: date) -> str:
+    # anything we don't recognize is stored like a bus route
+    mode = ROUTE_KIND.get(route_id, "bus")
 
     # commuter rail lines have dashes in both route id and stop id, so use underscores as delimiter
     # ex, CR-Fairmount_0_DB-2205-01/
-    if route_id in ROUTES_CR:
+    if mode == "cr":
         delimiter = "_"
         stop_path = f"{route_id}{delimiter}{direction_id}{delimiter}{stop_id}"
-        mode = "cr"
     # rapid transit doesn't need to be split by direction or line
-    elif route_id in ROUTES_RAPID:
+    elif mode == "rapid":
         stop_path = f"{stop_id}"
-        mode = "rapid"
     else:
         delimiter = "-"
         stop_path = f"{route_id}{delimiter}{direction_id}{delimiter}{stop_id}"
-        mode = "bus"
 
     return os.path.join(
         f"daily-{mode}-data",